@@ -1,10 +1,24 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 import requests
 import os
 import uuid
 from typing import Optional
 import time
+import asyncio
+import anyio
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import json
+import sqlite3
+import stat
+import tempfile
+import threading
+from concurrent.futures import Future
+from contextlib import closing
 
 from pathlib import Path
 
@@ -65,7 +79,15 @@ def send_email(sender_email, receiver_email, subject, body, smtp_server, smtp_po
 def current_milli_time():
     return round(time.time() * 1000)
 
-app = FastAPI(title="Order Processing API")
+@asynccontextmanager
+async def lifespan(app):
+    # endpoints are sync and run in anyio's threadpool; size it so an admitted
+    # request never queues for a thread (see MAX_CONCURRENCY); each may use a
+    # second thread for idempotency bookkeeping while its endpoint runs
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 2 * MAX_CONCURRENCY + THREADPOOL_HEADROOM
+    yield
+
+app = FastAPI(title="Order Processing API", lifespan=lifespan)
 
 class OrderRequest(BaseModel):
     SupplierID: str
@@ -128,6 +150,496 @@ FIRST_API_URL = "https://true.tabs.sale/fusion/v1/datasheets/dstrCZuqHqu1Ztil9x/
 SECOND_API_URL = "https://true.tabs.sale/fusion/v1/datasheets/dstFwmrR9HEFNCfplx/records"
 TH_API_URL     = "https://true.tabs.sale/fusion/v1/datasheets/dstVuLSABiS7rhxyCG/records"
 
+# Admission control: every tenant token gets its own concurrency limit and a
+# bounded wait queue, so one tenant's bulk automation run can't starve the rest.
+TOKEN_CONCURRENCY = int(os.environ.get("ATLAS_TOKEN_CONCURRENCY", "4"))
+TOKEN_QUEUE_SIZE = int(os.environ.get("ATLAS_TOKEN_QUEUE_SIZE", "16"))
+TOKEN_QUEUE_TIMEOUT = float(os.environ.get("ATLAS_TOKEN_QUEUE_TIMEOUT", "10"))
+TOKEN_RETRY_AFTER = int(os.environ.get("ATLAS_TOKEN_RETRY_AFTER", "1"))
+
+TOKEN_STATS_SIZE = int(os.environ.get("ATLAS_TOKEN_STATS_SIZE", "1024"))
+# Cap on requests admitted across all tokens at once. The threadpool is sized
+# to match, so admitted requests only ever wait at the gates below, where the
+# queue deadline applies.
+MAX_CONCURRENCY = int(os.environ.get("ATLAS_MAX_CONCURRENCY", "32"))
+# threads left for sync dependencies of requests that are not gated
+THREADPOOL_HEADROOM = 8
+
+class TokenGate:
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+
+# gates only exist while a token has requests running or queued; shed counts
+# outlive them in a bounded map
+token_gates = {}
+token_shed = OrderedDict()
+admitted = asyncio.Semaphore(MAX_CONCURRENCY)
+
+def token_id(authorization):
+    # never expose raw tokens in stats
+    return hashlib.sha256(authorization.encode()).hexdigest()[:12]
+
+def count_shed(tid):
+    token_shed[tid] = token_shed.pop(tid, 0) + 1
+    if len(token_shed) > TOKEN_STATS_SIZE:
+        token_shed.popitem(last=False)
+
+def drop_idle_gate(tid, gate):
+    if gate.active == 0 and gate.waiting == 0 and token_gates.get(tid) is gate:
+        del token_gates[tid]
+
+async def acquire_within(semaphore, timeout):
+    if not semaphore.locked():
+        await semaphore.acquire()
+        return
+    await asyncio.wait_for(semaphore.acquire(), max(timeout, 0.001))
+
+def shed_response(detail):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": detail},
+        headers={"Retry-After": str(TOKEN_RETRY_AFTER)}
+    )
+
+async def admission_control(request: Request, call_next):
+    authorization = request.headers.get("authorization")
+    if not authorization or not authorization.startswith("Bearer "):
+        # validate_token rejects these without calling the upstream
+        return await call_next(request)
+
+    tid = token_id(authorization)
+    gate = token_gates.get(tid)
+    if gate is None:
+        gate = token_gates[tid] = TokenGate(TOKEN_CONCURRENCY)
+
+    if gate.semaphore.locked() and gate.waiting >= TOKEN_QUEUE_SIZE:
+        count_shed(tid)
+        return shed_response("Too many concurrent requests for this token")
+
+    deadline = time.monotonic() + TOKEN_QUEUE_TIMEOUT
+    gate.waiting += 1
+    try:
+        await acquire_within(gate.semaphore, TOKEN_QUEUE_TIMEOUT)
+        try:
+            await acquire_within(admitted, deadline - time.monotonic())
+        except BaseException:
+            gate.semaphore.release()
+            raise
+        gate.active += 1
+    except asyncio.TimeoutError:
+        count_shed(tid)
+        return shed_response("Request waited too long in the queue")
+    finally:
+        gate.waiting -= 1
+        drop_idle_gate(tid, gate)
+
+    try:
+        return await call_next(request)
+    finally:
+        gate.active -= 1
+        admitted.release()
+        gate.semaphore.release()
+        drop_idle_gate(tid, gate)
+
+@app.get("/admission_stats")
+def admission_stats():
+    tokens = {
+        tid: {"active": 0, "queued": 0, "shed": shed}
+        for tid, shed in token_shed.items()
+    }
+    for tid, gate in list(token_gates.items()):
+        stats = tokens.setdefault(tid, {"active": 0, "queued": 0, "shed": 0})
+        stats["active"] = gate.active
+        stats["queued"] = gate.waiting
+
+    return {
+        "limits": {
+            "max_concurrency": MAX_CONCURRENCY,
+            "concurrency": TOKEN_CONCURRENCY,
+            "queue_size": TOKEN_QUEUE_SIZE,
+            "queue_timeout": TOKEN_QUEUE_TIMEOUT
+        },
+        "tokens": tokens
+    }
+
+# Reads of reference datasheets (suppliers, clients, products) are cached in a
+# local SQLite file shared by all worker processes. This service never writes
+# to them, so edits show up after at most CACHE_TTL. Datasheets whose reads
+# feed a write (stock, order/sales lines) are always read live. The cache is
+# best-effort: a locked or broken cache file falls back to the upstream.
+def default_cache_path():
+    # the file holds tenants' supplier and client records, so it lives in a
+    # directory only this user can open
+    if not hasattr(os, "getuid"):
+        return os.path.join(tempfile.gettempdir(), "atlas", "cache.sqlite3")
+    directory = os.path.join(tempfile.gettempdir(), f"atlas-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"Cache directory {directory} is not private, set ATLAS_CACHE_PATH")
+    return os.path.join(directory, "cache.sqlite3")
+
+CACHE_PATH = os.environ.get("ATLAS_CACHE_PATH") or default_cache_path()
+CACHE_TTL = float(os.environ.get("ATLAS_CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.environ.get("ATLAS_CACHE_MAX_ENTRIES", "512"))
+CACHED_URLS = {GET_SUPPLIER_URL, GET_CLIENTS_URL, GET_PRODUCT_URL}
+
+def cache_connect():
+    return closing(sqlite3.connect(CACHE_PATH, timeout=10, isolation_level=None))
+
+os.makedirs(os.path.dirname(os.path.abspath(CACHE_PATH)), mode=0o700, exist_ok=True)
+os.close(os.open(CACHE_PATH, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600))
+os.chmod(CACHE_PATH, 0o600)
+
+with cache_connect() as conn:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS records_cache ("
+        "key TEXT PRIMARY KEY, url TEXT NOT NULL, expires REAL NOT NULL, body TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS records_cache_url ON records_cache (url)")
+
+def get_records(url, view_id, authorization):
+    key = hashlib.sha256(f"{url}|{view_id}|{authorization}".encode()).hexdigest()
+    now = time.time()
+    cached = CACHE_TTL > 0 and url in CACHED_URLS
+
+    if cached:
+        try:
+            with cache_connect() as conn:
+                row = conn.execute(
+                    "SELECT body FROM records_cache WHERE key = ? AND expires > ?", (key, now)
+                ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is not None:
+            return json.loads(row[0])
+
+    resp = requests.get(
+        f"{url}?viewId={view_id}&fieldKey=name",
+        headers={
+            "Authorization": authorization
+        }
+    )
+    resp.raise_for_status()
+    result = resp.json()
+
+    if cached:
+        try:
+            with cache_connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO records_cache (key, url, expires, body) VALUES (?, ?, ?, ?)",
+                    (key, url, now + CACHE_TTL, json.dumps(result))
+                )
+                conn.execute("DELETE FROM records_cache WHERE expires <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM records_cache WHERE key NOT IN "
+                    "(SELECT key FROM records_cache ORDER BY expires DESC LIMIT ?)",
+                    (CACHE_MAX_ENTRIES,)
+                )
+        except sqlite3.Error:
+            pass
+
+    return result
+
+def invalidate_records(url):
+    # called after every write; only cached datasheets need the shared lock
+    if url not in CACHED_URLS:
+        return
+    try:
+        with cache_connect() as conn:
+            conn.execute("DELETE FROM records_cache WHERE url = ?", (url,))
+    except sqlite3.Error:
+        pass
+
+# Idempotency: automations sometimes re-fire the same trigger. A POST with an
+# Idempotency-Key header (or, on the endpoints below, the same body) replays the
+# first response instead of repeating the upstream calls. Concurrent duplicates
+# wait for the first request to finish. Keys live in the shared cache file, so
+# this holds across workers too. Body-derived keys only catch re-fires, so they
+# expire much sooner than explicit keys: the same stock record legitimately
+# triggers a new reorder each time it runs low.
+IDEMPOTENT_PATHS = {"/new_order", "/create_purchase", "/create_payment"}
+IDEMPOTENCY_TTL = float(os.environ.get("ATLAS_IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_BODY_TTL = float(os.environ.get("ATLAS_IDEMPOTENCY_BODY_TTL", "60"))
+IDEMPOTENCY_WAIT = float(os.environ.get("ATLAS_IDEMPOTENCY_WAIT", "60"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("ATLAS_IDEMPOTENCY_MAX_ENTRIES", "4096"))
+
+with cache_connect() as conn:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS idempotency ("
+        "key TEXT PRIMARY KEY, expires REAL NOT NULL, status_code INTEGER, body BLOB)"
+    )
+
+def idempotency_key(request, body):
+    # Returns (key, ttl) or None when the request isn't deduplicated.
+    key = request.headers.get("idempotency-key")
+    ttl = IDEMPOTENCY_TTL
+    if key is None:
+        if request.url.path not in IDEMPOTENT_PATHS:
+            return None
+        ttl = IDEMPOTENCY_BODY_TTL
+        try:
+            key = json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            key = body.decode(errors="replace")
+
+    scope = "|".join([
+        request.url.path,
+        request.headers.get("authorization", ""),
+        request.headers.get("view-id", ""),
+        key
+    ])
+    return hashlib.sha256(scope.encode()).hexdigest(), ttl
+
+def idempotency_claim(key):
+    # Returns None when this request owns the key, otherwise the stored
+    # (status_code, body) row; status_code is None while the owner is running.
+    now = time.time()
+    with cache_connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM idempotency WHERE expires <= ?", (now,))
+            row = conn.execute(
+                "SELECT status_code, body FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                # pending claims expire so a crashed worker doesn't block the key
+                # forever; a running owner keeps extending its claim
+                conn.execute(
+                    "INSERT INTO idempotency (key, expires) VALUES (?, ?)",
+                    (key, now + IDEMPOTENCY_WAIT)
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return row
+
+def idempotency_extend(key):
+    with cache_connect() as conn:
+        conn.execute(
+            "UPDATE idempotency SET expires = ? WHERE key = ? AND status_code IS NULL",
+            (time.time() + IDEMPOTENCY_WAIT, key)
+        )
+
+async def idempotency_keepalive(key):
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_WAIT / 3)
+        await run_in_threadpool(idempotency_extend, key)
+
+def idempotency_store(key, ttl, status_code, body):
+    with cache_connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO idempotency (key, expires, status_code, body) VALUES (?, ?, ?, ?)",
+            (key, time.time() + ttl, status_code, body)
+        )
+        # pending claims are never evicted, their owners are still running
+        conn.execute(
+            "DELETE FROM idempotency WHERE status_code IS NOT NULL AND key NOT IN "
+            "(SELECT key FROM idempotency WHERE status_code IS NOT NULL "
+            "ORDER BY expires DESC LIMIT ?)",
+            (IDEMPOTENCY_MAX_ENTRIES,)
+        )
+
+def idempotency_release(key):
+    with cache_connect() as conn:
+        conn.execute("DELETE FROM idempotency WHERE key = ? AND status_code IS NULL", (key,))
+
+@app.middleware("http")
+async def idempotency(request: Request, call_next):
+    if request.method != "POST":
+        return await call_next(request)
+
+    claim = idempotency_key(request, await request.body())
+    if claim is None:
+        return await call_next(request)
+    key, ttl = claim
+
+    # sqlite calls run in the threadpool: BEGIN IMMEDIATE may wait on another
+    # worker's lock and must not stall the event loop for every tenant
+    deadline = time.time() + IDEMPOTENCY_WAIT
+    delay = 0.05
+    while True:
+        row = await run_in_threadpool(idempotency_claim, key)
+        if row is None:
+            break
+        if row[0] is not None:
+            return Response(
+                content=row[1],
+                status_code=row[0],
+                media_type="application/json",
+                headers={"Idempotent-Replayed": "true"}
+            )
+        if time.time() >= deadline:
+            return JSONResponse(
+                status_code=409,
+                content={"detail": "A request with this idempotency key is still in progress"}
+            )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+    keepalive = asyncio.create_task(idempotency_keepalive(key))
+    try:
+        response = await call_next(request)
+
+        # only successful responses are replayed, failures may be retried
+        if response.status_code != 200:
+            keepalive.cancel()
+            await run_in_threadpool(idempotency_release, key)
+            return response
+
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        keepalive.cancel()
+        try:
+            await run_in_threadpool(idempotency_store, key, ttl, response.status_code, body)
+        except sqlite3.Error:
+            # the upstream writes already happened, the response must still go out
+            await run_in_threadpool(idempotency_release, key)
+    except BaseException:
+        keepalive.cancel()
+        await run_in_threadpool(idempotency_release, key)
+        raise
+
+    return Response(
+        content=body,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type
+    )
+
+# Registered last so it runs first: over-limit requests are shed before they
+# touch the idempotency store, and duplicates waiting for the first request
+# hold one of their token's slots.
+app.middleware("http")(admission_control)
+
+# Write coalescing: concurrent single-record PATCHes to the same datasheet are
+# collected for a few milliseconds and sent as one multi-record request. The
+# first caller of a batch sends it; every caller gets back its own record.
+# Batches are only held open while the datasheet is busy, and a batch rejected
+# with a 4xx is resent record by record.
+WRITE_COALESCE_WINDOW = float(os.environ.get("ATLAS_WRITE_COALESCE_MS", "5")) / 1000
+WRITE_BURST_GAP = float(os.environ.get("ATLAS_WRITE_BURST_GAP_MS", "1000")) / 1000
+WRITE_BATCH_LIMIT = 10  # records per request accepted by the TrueTabs API
+
+class WriteBatch:
+    def __init__(self):
+        self.records = []
+        self.futures = []
+        self.full = threading.Event()
+
+write_batches = {}
+write_batches_lock = threading.Lock()
+write_last_flush = {}  # datasheet url -> time its last batch was sent
+
+def record_result(result, record_id):
+    data = result.get("data") if isinstance(result, dict) else None
+    if not isinstance(data, dict) or not isinstance(data.get("records"), list):
+        return result
+    return {
+        **result,
+        "data": {
+            **data,
+            "records": [
+                r for r in data["records"]
+                if isinstance(r, dict) and r.get("recordId") == record_id
+            ]
+        }
+    }
+
+def send_writes(url, view_id, authorization, records):
+    response = requests.patch(
+        f"{url}?viewId={view_id}&fieldKey=name",
+        headers={
+            "Authorization": authorization,
+            "Content-Type": "application/json"
+        },
+        json={
+            "records": records,
+            "fieldKey": "name"
+        }
+    )
+
+    invalidate_records(url)
+    response.raise_for_status()
+    return response.json()
+
+def rejected_by_upstream(e):
+    # only these can be caused by a single bad record; auth errors and rate
+    # limiting hit every record alike
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in (400, 422)
+
+def send_batch(url, view_id, authorization, batch):
+    write_last_flush[url] = time.time()
+    try:
+        result = send_writes(url, view_id, authorization, batch.records)
+    except Exception as e:
+        if len(batch.records) == 1 or not rejected_by_upstream(e):
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+
+        # resend one by one so only the bad record's caller sees the error
+        for record, future in zip(batch.records, batch.futures):
+            try:
+                future.set_result(send_writes(url, view_id, authorization, [record]))
+            except Exception as record_error:
+                future.set_exception(record_error)
+        return
+
+    for record, future in zip(batch.records, batch.futures):
+        future.set_result(record_result(result, record["recordId"]))
+
+def flush_writes(url, view_id, authorization, batch):
+    # every caller blocks on its future, so each one is resolved even if
+    # sending or unpacking the batch fails unexpectedly
+    error = None
+    try:
+        send_batch(url, view_id, authorization, batch)
+    except Exception as e:
+        error = e
+    finally:
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(error or RuntimeError("Batched write was not sent"))
+
+def patch_record(url, view_id, authorization, record_id, fields):
+    key = (url, view_id, authorization)
+    future = Future()
+
+    with write_batches_lock:
+        batch = write_batches.get(key)
+        if batch is not None and any(r["recordId"] == record_id for r in batch.records):
+            # the same record twice in one request is ambiguous, send the open batch now
+            del write_batches[key]
+            batch.full.set()
+            batch = None
+
+        leader = batch is None
+        if leader:
+            batch = write_batches[key] = WriteBatch()
+
+        batch.records.append({"recordId": record_id, "fields": fields})
+        batch.futures.append(future)
+        if len(batch.records) >= WRITE_BATCH_LIMIT:
+            del write_batches[key]
+            batch.full.set()
+
+    if leader:
+        # only hold the batch open while the datasheet sees a burst of writes,
+        # a lone write goes out immediately
+        if time.time() - write_last_flush.get(url, 0) < WRITE_BURST_GAP:
+            batch.full.wait(WRITE_COALESCE_WINDOW)
+        with write_batches_lock:
+            if write_batches.get(key) is batch:
+                del write_batches[key]
+        flush_writes(url, view_id, authorization, batch)
+
+    return future.result()
+
 def validate_token(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header format")
@@ -137,20 +649,13 @@ def validate_viewId(VIEW_ID: str = Header(...)):
     return VIEW_ID
 
 @app.post("/create_purchase")
-async def create_purchase(
+def create_purchase(
     order: CreatePurchase,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_sup_resp = requests.get(
-            f"{GET_ORDERLINE_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_sup_resp.raise_for_status()
-        get_sup_response = get_sup_resp.json()
+        get_sup_response = get_records(GET_ORDERLINE_URL, VIEW_ID, authorization)
 
         QtyOrdered = 0
         UnitPrice = 0
@@ -183,30 +688,17 @@ async def create_purchase(
             }
         )
         
+        invalidate_records(GET_PURCHASES_URL)
         second_response.raise_for_status()
         second_result = second_response.json()
 
-        th_response = requests.patch(
-            f"{GET_PURCHASE_ORDERS_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization,
-                "Content-Type": "application/json"
-            },
-            json={
-                "records": [
-                    {
-                        "recordId": order.recordId,
-                        "fields": {
-                            "IsSent": True
-                        }
-                    }
-                ],
-                "fieldKey": "name"
-            }
+        th_result = patch_record(
+            GET_PURCHASE_ORDERS_URL,
+            VIEW_ID,
+            authorization,
+            order.recordId,
+            {"IsSent": True}
         )
-        
-        th_response.raise_for_status()
-        th_result = th_response.json()
 
         return {
             "status": "success",
@@ -219,33 +711,19 @@ async def create_purchase(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/payment_notification")
-async def payment_notification(
+def payment_notification(
     order: NotificationSentCheck,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        th_response = requests.patch(
-            f"{GET_PAYMENTS_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization,
-                "Content-Type": "application/json"
-            },
-            json={
-                "records": [
-                    {
-                        "recordId": order.recordId,
-                        "fields": {
-                            "IsNotificationSent": True
-                        }
-                    }
-                ],
-                "fieldKey": "name"
-            }
+        th_result = patch_record(
+            GET_PAYMENTS_URL,
+            VIEW_ID,
+            authorization,
+            order.recordId,
+            {"IsNotificationSent": True}
         )
-        
-        th_response.raise_for_status()
-        th_result = th_response.json()
 
         return {
             "status": "success",
@@ -255,7 +733,7 @@ async def payment_notification(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/log_transaction")
-async def log_transaction(
+def log_transaction(
     order: LogTransaction,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
@@ -288,6 +766,7 @@ async def log_transaction(
             }
         )
         
+        invalidate_records(GET_FINANCIAL_URL)
         second_response.raise_for_status()
         second_result = second_response.json()
 
@@ -300,20 +779,13 @@ async def log_transaction(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/create_payment")
-async def create_payment(
+def create_payment(
     order: CreatePayment,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_sup_resp = requests.get(
-            f"{GET_SALESLINES_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_sup_resp.raise_for_status()
-        get_sup_response = get_sup_resp.json()
+        get_sup_response = get_records(GET_SALESLINES_URL, VIEW_ID, authorization)
 
         QtyOrdered = 0
         UnitPrice = 0
@@ -350,6 +822,7 @@ async def create_payment(
             }
         )
         
+        invalidate_records(GET_PAYMENTS_URL)
         second_response.raise_for_status()
         second_result = second_response.json()
 
@@ -363,20 +836,13 @@ async def create_payment(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/sale_order")
-async def sale_order(
+def sale_order(
     order: SaleOrder,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_pr_resp = requests.get(
-            f"{GET_SALESLINES_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_pr_resp.raise_for_status()
-        get_pr_response = get_pr_resp.json()
+        get_pr_response = get_records(GET_SALESLINES_URL, VIEW_ID, authorization)
 
         productId = ""
         QtyOrdered = 0
@@ -388,14 +854,7 @@ async def sale_order(
 
 
 
-        get_sup_resp = requests.get(
-            f"{GET_CLIENTS_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_sup_resp.raise_for_status()
-        get_sup_response = get_sup_resp.json()
+        get_sup_response = get_records(GET_CLIENTS_URL, VIEW_ID, authorization)
 
         email = ""
         for i in get_sup_response['data']['records']:
@@ -403,14 +862,7 @@ async def sale_order(
                 email = i['fields']['Email']
                 break
 
-        get_stock_resp = requests.get(
-            f"{TH_API_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_stock_resp.raise_for_status()
-        get_stock_response = get_stock_resp.json()
+        get_stock_response = get_records(TH_API_URL, VIEW_ID, authorization)
 
         stockId = ""
         currentQty = 0
@@ -456,6 +908,7 @@ async def sale_order(
             }
         )
         
+        invalidate_records(TH_API_URL)
         th_response.raise_for_status()
         th_result = th_response.json()
 
@@ -468,20 +921,13 @@ async def sale_order(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/accept_receipt")
-async def accept_receipt(
+def accept_receipt(
     order: AcceptReceiptRequest,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_sup_resp = requests.get(
-            f"{TH_API_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_sup_resp.raise_for_status()
-        get_sup_response = get_sup_resp.json()
+        get_sup_response = get_records(TH_API_URL, VIEW_ID, authorization)
 
         stockId = ""
         currentQty = 0
@@ -511,33 +957,20 @@ async def accept_receipt(
             }
         )
         
+        invalidate_records(TH_API_URL)
         th_response.raise_for_status()
         th_result = th_response.json()
 
 
 
-        re_response = requests.patch(
-            f"{GET_RECEIPTS_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization,
-                "Content-Type": "application/json"
-            },
-            json={
-                "records": [
-                    {
-                        "recordId": order.recordId,
-                        "fields": {
-                            "isUpdated": True
-                        }
-                    }
-                ],
-                "fieldKey": "name"
-            }
+        re_result = patch_record(
+            GET_RECEIPTS_URL,
+            VIEW_ID,
+            authorization,
+            order.recordId,
+            {"isUpdated": True}
         )
 
-        re_response.raise_for_status()
-        re_result = re_response.json()
-
         return {
             "status": "success",
             "order_result": th_result,
@@ -548,20 +981,13 @@ async def accept_receipt(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/send_order")
-async def send_order(
+def send_order(
     order: SendOrderRequest,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_sup_resp = requests.get(
-            f"{GET_SUPPLIER_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_sup_resp.raise_for_status()
-        get_sup_response = get_sup_resp.json()
+        get_sup_response = get_records(GET_SUPPLIER_URL, VIEW_ID, authorization)
 
         email = ""
         for i in get_sup_response['data']['records']:
@@ -569,14 +995,7 @@ async def send_order(
                 email = i['fields']['Email']
                 break
 
-        get_resp = requests.get(
-            f"{GET_ORDERLINE_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_resp.raise_for_status()
-        get_response = get_resp.json()
+        get_response = get_records(GET_ORDERLINE_URL, VIEW_ID, authorization)
 
         nQtyOrdered = 0
         nUnitPrice = 0
@@ -624,20 +1043,13 @@ async def send_order(
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
 @app.post("/new_order")
-async def new_order(
+def new_order(
     order: OrderRequest,
     authorization: str = Depends(validate_token),
     VIEW_ID: str = Depends(validate_viewId)
 ):
     try:
-        get_resp = requests.get(
-            f"{GET_PRODUCT_URL}?viewId={VIEW_ID}&fieldKey=name",
-            headers={
-                "Authorization": authorization
-            }
-        )
-        get_resp.raise_for_status()
-        get_response = get_resp.json()
+        get_response = get_records(GET_PRODUCT_URL, VIEW_ID, authorization)
 
         ReorderQty = 0
         UnitCost = 0
@@ -670,6 +1082,7 @@ async def new_order(
             }
         )
         
+        invalidate_records(SECOND_API_URL)
         second_response.raise_for_status()
         second_result = second_response.json()
         print(f"\n\nABCV{second_result}\n\n")
@@ -697,6 +1110,7 @@ async def new_order(
             }
         )
         
+        invalidate_records(FIRST_API_URL)
         first_response.raise_for_status()
         first_result = first_response.json()
 
@@ -721,6 +1135,7 @@ async def new_order(
             }
         )
         
+        invalidate_records(TH_API_URL)
         th_response.raise_for_status()
         th_result = th_response.json()
         
@@ -735,7 +1150,12 @@ async def new_order(
     except requests.exceptions.RequestException as e:
         raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
 
-#if __name__ == "__main__":
-#    #import uvicorn
-#    #uvicorn.run(app, host="0.0.0.0", port=8000)
-#    #app.run()#
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("ATLAS_HOST", "0.0.0.0"),
+        port=int(os.environ.get("ATLAS_PORT", "8000")),
+        workers=int(os.environ.get("ATLAS_WORKERS", "1"))
+    )
+